@@ -6,22 +6,40 @@
 # Usage:
 # python ./mspm0_prog.py [--port COMx] [--auto] firmware.hex
 # python ./mspm0_prog.py --port none --saveflashfile firmware.hex
-# python ./mspm0_prog.py [--port COMx] [--auto] firmware.flash  (todo - not currently implemented!)
+# python ./mspm0_prog.py --port none --saveflashfile [--flashversion 1|2] [--compress] firmware.hex
+# python ./mspm0_prog.py [--port COMx] [--auto] firmware.flash
 # python ./mspm0_prog.py [--port COMx] sim
+# python ./mspm0_prog.py convert [--outdir DIR] [--jobs N] firmware1.hex firmware2.hex dir_of_hex_files ...
+# python ./mspm0_prog.py [--port COMx] --auto --watch firmware.hex
+# python ./mspm0_prog.py [--port COMx] [--auto] --stream firmware.hex
+# python ./mspm0_prog.py [--port COMx] [--auto] [--repeat] --patch 0x7c00=@serial.bin firmware.hex
 # By specifying firmware.hex, the code will convert to a binary flash file, and then program it
 # By specifying firmware.flash, the code will program the flash file directly
 # By specifying sim, the code will simulate the MSPM0 BSL and respond to commands
 # the --auto option will not prompt the user, and will automatically try to boot/reset the device
-# the --saveflashfile option will save the interim flash file with a .flash suffix
+# the --saveflashfile option will save the interim flash file with a .flash suffix (v2 format by default)
+# the --device option selects a device profile, otherwise it is selected from the chip's device info
+# the convert subcommand converts many files to .flash files in parallel, without needing pySerial
+# the --stream option programs the .hex file while it is being read, holding only one sector in memory
+# the --watch option keeps the serial port open and re-programs whenever the .hex file changes
+# the --patch ADDR=@FILE|0xVALUE|HEXBYTES option programs per-unit data (e.g. serial number) on top of the firmware,
+# and with --repeat, units are programmed one after another from the same preloaded firmware
 
 import argparse
-import serial
 import binascii
 import time
+import os
+import select
+import struct
+import hashlib
+import zlib
+import sys
 
+serial = None  # pySerial module, imported on first use by import_serial()
 port = 'COM6'  # Adjust this to your serial port
 baudrate = 9600  # Standard baudrate for MSPM0 BSL
 ser = None  # Serial port object, initialized later
+verbose = True  # set to False to suppress the detailed conversion output
 
 # bytearray to hold the entire data packet to send over serial port.
 # format will be:
@@ -39,11 +57,53 @@ data_for_verification_calc = bytearray()
 addr_len_list= []  # List of tuples (address, length) for each address range
 data_list = []  # List of bytearrays to hold the data for each address range
 interim_file_data = bytearray()  # This will hold the interim file data
+# .flash file v2 format settings
+FLASH_MAGIC = b'MSPF'  # v1 files start with 256 0x00 bytes instead
+FLASH_VERSION = 2
+FLASH_FLAG_COMPRESSED = 0x0001  # DATA section is zlib compressed
+# precomputed Program Data (0x20) packets built from the interim file data, ready to send
+packet_stream = []  # List of tuples (address, data, packet) for each address range
+# packet_stream re-sized for the connected device, cached so it is only re-sized once per loaded image
+sized_packet_stream = None
+sized_packet_data = None  # the max_packet_data that sized_packet_stream was built for
+
+# device profiles for the MSPM0 family. The profile is selected by matching the Get Device Info (0x19)
+# response against the expected values, so only add a device once all of its values are known.
+# flash_size and sector_size are in bytes. max_packet_data is the most data bytes to send in one
+# Program Data (0x20) packet, or None to size packets from the BSL Max Buffer Size in the 0x19 response.
+# Devices that respond identically (e.g. parts that differ only in flash size) can't be told apart, so only
+# one of them has auto_select set, and the others must be picked with --device. If several auto_select
+# profiles ever match, the settings they have in common are used, and the flash size is not checked.
+device_profiles = [
+    {'name': 'MSPM0L1105', 'auto_select': True, 'flash_size': 32 * 1024, 'sector_size': 1024, 'max_packet_data': None,
+     'min_bsl_buf_size': 1024, 'cmd_interp_version': 0x0100, 'build_id': 0x0100, 'app_ver': 0x00000000,
+     'plugin_ver': 0x0001, 'bsl_buf_start_addr': 0x20000160, 'bcr_id': 0x00000001, 'bsl_id': 0x00000001},
+    # responds the same as the MSPM0L1105, so requires --device MSPM0L1106
+    {'name': 'MSPM0L1106', 'auto_select': False, 'flash_size': 64 * 1024, 'sector_size': 1024, 'max_packet_data': None,
+     'min_bsl_buf_size': 1024, 'cmd_interp_version': 0x0100, 'build_id': 0x0100, 'app_ver': 0x00000000,
+     'plugin_ver': 0x0001, 'bsl_buf_start_addr': 0x20000160, 'bcr_id': 0x00000001, 'bsl_id': 0x00000001},
+]
+DEFAULT_DEVICE = 'MSPM0L1105'  # device profile used for .hex conversion when no device is specified
+DEFAULT_PACKET_DATA = 1024  # data bytes per packet when the profile does not limit it
+PACKET_OVERHEAD = 12  # header, length, command, address and CRC32 bytes around the data in a 0x20 packet
+MAIN_FLASH_END = 0x20000000  # addresses below this are main flash, and are checked against flash_size
+# device profile name, set by --device or from a .flash v2 file. If None, the profile is selected
+# from the Get Device Info (0x19) response
+target_device = None
 
 # serial port capabilities; set to False if you don't want to use RTS/DTR
 rts_capability = True
 dtr_capability = True
 
+# watch mode settings
+watch_debounce = 0.5  # seconds of quiet after the last file change before re-programming
+watch_poll_interval = 0.5  # seconds between checks when inotify is not available
+# inotify event masks (from linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
 # calc_crc - calculates CRC32 bytes for the entire given payload.
 # example: to calculate CRC for data_packet[3:] (after header and 2-byte length):
 # calc_crc(data_packet[3:])
@@ -93,6 +153,148 @@ def print_banner():
     print(" ");
 
 
+def get_device_profile(name):
+    """Return the device profile with the given name, or None if there isn't one."""
+    for profile in device_profiles:
+        if profile['name'].lower() == name.lower():
+            return profile
+    return None
+
+def conversion_chunk_size():
+    """Return the number of data bytes per entry to use when converting, based on the target device profile."""
+    profile = get_device_profile(target_device or DEFAULT_DEVICE)
+    return profile['max_packet_data'] or DEFAULT_PACKET_DATA
+
+def select_device_profile(device_info):
+    """Select the device profile that matches the Get Device Info (0x19) response, or return None.
+    If target_device is set, only that profile is considered, otherwise only the auto_select profiles are.
+    If several profiles match, return a profile with the settings they have in common, and with flash_size set to None."""
+    matches = []
+    for profile in device_profiles:
+        if target_device is not None and profile['name'] != target_device:
+            continue
+        if target_device is None and not profile['auto_select']:
+            continue
+        mismatches = []
+        for field in ['cmd_interp_version', 'build_id', 'app_ver', 'plugin_ver', 'bsl_buf_start_addr', 'bcr_id', 'bsl_id']:
+            if device_info[field] != profile[field]:
+                mismatches.append(f"{field} {device_info[field]:#x} (expected {profile[field]:#x})")
+        if device_info['bsl_max_buf_size'] < profile['min_bsl_buf_size']:
+            mismatches.append(f"bsl_max_buf_size {device_info['bsl_max_buf_size']:#x} (expected at least {profile['min_bsl_buf_size']:#x})")
+        if len(mismatches) == 0:
+            matches.append(profile)
+        else:
+            print(f"Device profile {profile['name']} does not match: {', '.join(mismatches)}")
+    if len(matches) <= 1:
+        return matches[0] if matches else None
+    names = ', '.join(profile['name'] for profile in matches)
+    sector_sizes = set(profile['sector_size'] for profile in matches)
+    if len(sector_sizes) != 1:
+        print(f"***** ERROR: Device info matches {names}, which have different sector sizes, use --device to choose one. ******")
+        return None
+    print(f"Device info matches {names}, the flash size will not be checked (use --device to choose one)")
+    max_packet_data_list = [profile['max_packet_data'] for profile in matches if profile['max_packet_data'] is not None]
+    return {'name': '/'.join(profile['name'] for profile in matches), 'flash_size': None,
+            'sector_size': sector_sizes.pop(), 'max_packet_data': min(max_packet_data_list) if max_packet_data_list else None}
+
+def restream_packets(stream, max_data):
+    """Return the stream with contiguous entries merged and re-split into packets of up to max_data bytes.
+    Entries whose address and length don't change keep their precomputed packets."""
+    # find runs of contiguous entries, as (start address, list of entries)
+    runs = []
+    for entry in stream:
+        addr, data, packet = entry
+        if len(runs) > 0 and runs[-1][0] + sum(len(e[1]) for e in runs[-1][1]) == addr:
+            runs[-1][1].append(entry)
+        else:
+            runs.append((addr, [entry]))
+    layout = []
+    for run_addr, run_entries in runs:
+        run_length = sum(len(e[1]) for e in run_entries)
+        for offset in range(0, run_length, max_data):
+            layout.append((run_addr + offset, min(max_data, run_length - offset)))
+    if layout == [(addr, len(data)) for addr, data, packet in stream]:
+        return stream  # already sized correctly, nothing to rebuild
+    existing = {(addr, len(data)): (addr, data, packet) for addr, data, packet in stream}
+    new_stream = []
+    rebuilt = 0
+    for run_addr, run_entries in runs:
+        run_data = b''.join(e[1] for e in run_entries)
+        for offset in range(0, len(run_data), max_data):
+            chunk = run_data[offset:offset + max_data]
+            if (run_addr + offset, len(chunk)) in existing:
+                new_stream.append(existing[(run_addr + offset, len(chunk))])
+            else:
+                new_stream.append(make_stream_entry(run_addr + offset, chunk))
+                rebuilt += 1
+    print(f"Re-sized packets for up to {max_data} data bytes: {len(stream)} -> {len(new_stream)} packet(s), {rebuilt} rebuilt")
+    return new_stream
+
+def hex_records(hex_file):
+    """Read an Intel HEX file one line at a time, and yield (address, data) for each data record."""
+    upper_addr_word = 0x0000
+    with open(hex_file, 'r') as f:
+        for line_num, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or not line.startswith(':'):
+                if verbose:
+                    print(f"line # {line_num}: Skipping content: '{line}'")
+                continue
+            if verbose:
+                print(f"processing line {line_num}: {line}")
+            try:
+                byte_count  = int(line[1:3], 16)
+                addr16      = int(line[3:7], 16)
+                record_type = int(line[7:9], 16)
+                data        = bytes.fromhex(line[9:9 + 2*byte_count])
+            except ValueError as e:
+                print(f"Error parsing line '{line}': {e}")
+                continue  # keep going
+            if record_type == 4:
+                # Extended Linear Address
+                upper_addr_word = int.from_bytes(data, 'big') << 16
+            elif record_type == 0:
+                # Data record
+                yield ((upper_addr_word | addr16) & 0xFFFFFFFF, data)
+            elif record_type == 1:
+                if verbose:
+                    print(f"End of file record (0x01) on line {line_num}, finished reading .hex file")
+                return
+            else:
+                # other record types
+                continue
+
+def hex_sector_chunks(records, sector_size):
+    """Group (address, data) records into contiguous chunks that don't cross a sector boundary, and yield
+    (address, data) for each chunk as soon as it is complete, padded with 0xff to a multiple of 8 bytes.
+    Raises ValueError if a chunk is not 8-byte aligned."""
+    chunk_start = None
+    chunk = bytearray()
+    for addr, data in records:
+        offset = 0
+        while offset < len(data):
+            if chunk_start is not None and addr + offset != chunk_start + len(chunk):
+                # non-contiguous -> finish the current chunk first
+                chunk.extend(bytearray([0xff] * (-len(chunk) % 8)))
+                yield (chunk_start, chunk)
+                chunk_start = None
+            if chunk_start is None:
+                chunk_start = addr + offset
+                chunk = bytearray()
+                if chunk_start % 8 != 0:
+                    raise ValueError(f"Address {chunk_start:#010x} is not 8-byte aligned")
+            # take as much as fits in the current sector
+            sector_end = (chunk_start // sector_size + 1) * sector_size
+            take = min(len(data) - offset, sector_end - (chunk_start + len(chunk)))
+            chunk.extend(data[offset:offset + take])
+            offset += take
+            if chunk_start + len(chunk) == sector_end:
+                yield (chunk_start, chunk)
+                chunk_start = None
+    if chunk_start is not None:
+        chunk.extend(bytearray([0xff] * (-len(chunk) % 8)))
+        yield (chunk_start, chunk)
+
 def hexparse(hex_file):
     """Read an Intel HEX file to memory and parse it into address and data lists."""
     global addr_len_list
@@ -102,20 +304,19 @@ def hexparse(hex_file):
     data_list = []
 
     cur_data_bytes = bytearray()
-    max_data_len = 1024
+    max_data_len = conversion_chunk_size()
     tot_data_len = 0
-    upper_addr_word = 0x0000
 
     current_range_start = None  # track the start address for the current contiguous range
 
     def flush_current():
-        """Flush cur_data_bytes into data_list/addr_len_list using 1024-byte chunks + final partial."""
+        """Flush cur_data_bytes into data_list/addr_len_list using max_data_len chunks + final partial."""
         nonlocal cur_data_bytes, current_range_start, tot_data_len
         if current_range_start is None or len(cur_data_bytes) == 0:
             return
         start = current_range_start
         buf = cur_data_bytes
-        # full 1024-byte chunks
+        # full max_data_len chunks
         while len(buf) >= max_data_len:
             data_list.append(bytearray(buf[:max_data_len]))
             addr_len_list.append((start, max_data_len))
@@ -131,54 +332,29 @@ def hexparse(hex_file):
         cur_data_bytes = bytearray()
         current_range_start = None
 
-    with open(hex_file, 'r') as f:
-        for line_num, line in enumerate(f, start=1):
-            line = line.strip()
-            if not line or not line.startswith(':'):
-                print(f"line # {line_num}: Skipping content: '{line}'")
-                continue
-            print(f"processing line {line_num}: {line}")
-            try:
-                byte_count  = int(line[1:3], 16)
-                addr16      = int(line[3:7], 16)
-                record_type = int(line[7:9], 16)
-                data        = bytes.fromhex(line[9:9 + 2*byte_count])
-            except ValueError as e:
-                print(f"Error parsing line '{line}': {e}")
-                continue  # keep going
-            if record_type == 4:
-                # Extended Linear Address
-                upper_addr_word = int.from_bytes(data, 'big') << 16
-            elif record_type == 0:
-                # Data record
-                addr32 = (upper_addr_word | addr16) & 0xFFFFFFFF
-                # Start new range or check contiguity
-                if current_range_start is None:
-                    current_range_start = addr32
-                elif addr32 != (current_range_start + len(cur_data_bytes)):
-                    # non-contiguous -> flush current range first
-                    flush_current()
-                    current_range_start = addr32
-                # append incoming bytes
-                cur_data_bytes.extend(data)
-                # Split out any full 1024-byte chunks immediately
-                while len(cur_data_bytes) >= max_data_len:
-                    data_list.append(bytearray(cur_data_bytes[:max_data_len]))
-                    addr_len_list.append((current_range_start, max_data_len))
-                    tot_data_len += max_data_len
-                    cur_data_bytes = cur_data_bytes[max_data_len:]
-                    current_range_start += max_data_len
-            elif record_type == 1:
-                print(f"End of file record (0x01) on line {line_num}, finished reading .hex file")
-                break
-            else:
-                # other record types
-                continue
+    for addr32, data in hex_records(hex_file):
+        # Start new range or check contiguity
+        if current_range_start is None:
+            current_range_start = addr32
+        elif addr32 != (current_range_start + len(cur_data_bytes)):
+            # non-contiguous -> flush current range first
+            flush_current()
+            current_range_start = addr32
+        # append incoming bytes
+        cur_data_bytes.extend(data)
+        # Split out any full max_data_len chunks immediately
+        while len(cur_data_bytes) >= max_data_len:
+            data_list.append(bytearray(cur_data_bytes[:max_data_len]))
+            addr_len_list.append((current_range_start, max_data_len))
+            tot_data_len += max_data_len
+            cur_data_bytes = cur_data_bytes[max_data_len:]
+            current_range_start += max_data_len
     # Final flush
     flush_current()
 
     # Sanity checks
-    print(f"Sanity checking the .hex content...")
+    if verbose:
+        print(f"Sanity checking the .hex content...")
     if len(addr_len_list) != len(data_list):
         print(f"**** ERROR: Length of addr_len_list ({len(addr_len_list)}) does not match length of data_list ({len(data_list)}), aborting! ****")
         return False
@@ -197,15 +373,18 @@ def hexparse(hex_file):
             padding_length = 8 - (length % 8)
             addr_pad_start = addr + length
             addr_pad_stop  = addr_pad_start + padding_length - 1
-            print(f"Data length for Entry {i} is not divisible by 8, padding..")
-            print(f"Padding Entry {i} with {padding_length} x '0xff' byte(s) at {addr_pad_start:#010x}-{addr_pad_stop:#010x}")
+            if verbose:
+                print(f"Data length for Entry {i} is not divisible by 8, padding..")
+                print(f"Padding Entry {i} with {padding_length} x '0xff' byte(s) at {addr_pad_start:#010x}-{addr_pad_stop:#010x}")
             data_list[i] += bytearray([0xff] * padding_length)
             addr_len_list[i] = (addr, length + padding_length)
 
-    for i, (addr, length) in enumerate(addr_len_list):
-        print(f"  Addr/Len Entry {i}: Address: {addr:#010x}, Length: {length} bytes")
-    for i, data in enumerate(data_list):
-        print(f"  Data Entry {i}: Length: {len(data)} bytes, Content: {data.hex()}")
+    if verbose:
+        for i, (addr, length) in enumerate(addr_len_list):
+            print(f"  Addr/Len Entry {i}: Address: {addr:#010x}, Length: {length} bytes")
+        for i, data in enumerate(data_list):
+            print(f"  Data Entry {i}: Length: {len(data)} bytes, Content: {data.hex()}")
+    return True
 
 
 def build_interim_array():
@@ -238,33 +417,308 @@ def build_interim_array():
         interim_file_data.extend(data)  # Append the data bytes
     # Print the interim file data for debugging
     # print in format: idx : data (hex) : data (ascii) 16 bytes per line
-    print("Interim file data:")
-    for i in range(0, len(interim_file_data), 16):
-        line = interim_file_data[i:i+16]
-        hex_data = ' '.join(f'{b:02x}' for b in line)
-        ascii_data = ''.join(chr(b) if 32 <= b < 127 else '.' for b in line)
-        print(f"{i:04x} : {hex_data:<48} : {ascii_data}")
+    if verbose:
+        print("Interim file data:")
+        for i in range(0, len(interim_file_data), 16):
+            line = interim_file_data[i:i+16]
+            hex_data = ' '.join(f'{b:02x}' for b in line)
+            ascii_data = ''.join(chr(b) if 32 <= b < 127 else '.' for b in line)
+            print(f"{i:04x} : {hex_data:<48} : {ascii_data}")
     return True
 
-def bootload_interim_array():
-    """Convert the interim file data to bootloader commands and send them to the MSPM0 chip."""
+def make_stream_entry(addr, data):
+    """Build a Program Data (0x20) packet for the given address and data, return as a packet_stream entry."""
+    build_packet(0x80, 0x20, addr.to_bytes(4, 'little') + data)
+    return (addr, bytes(data), bytes(data_packet))
+
+def build_packet_stream():
+    """Parse the interim file data and precompute the Program Data (0x20) packet for each address range."""
+    global packet_stream
+    global sized_packet_stream
+    packet_stream = []
+    sized_packet_stream = None
+    idx_addr_section = 256  # Index for the address in the interim file data
+    if interim_file_data[idx_addr_section:idx_addr_section+4] != b'ADDR':
+        print("***** ERROR: 'ADDR' section not found in interim file data, exiting. ******")
+        return False
+    num_addr_len_entries = int.from_bytes(interim_file_data[idx_addr_section+4:idx_addr_section+6], 'little')  # Number of addr_len entries
+    idx_addr_section += 6  # Move to the start of the addr_len section
+    idx_data_section = idx_addr_section + num_addr_len_entries * 6
+    # first two bytes after 'DATA' are the length of the first data entry
+    if interim_file_data[idx_data_section:idx_data_section+4] != b'DATA':
+        print("***** ERROR: 'DATA' section not found in interim file data, exiting. ******")
+        return False
+    idx_data_section += 4  # Move to the length of the first data entry
+    for i in range(num_addr_len_entries):
+        addr = int.from_bytes(interim_file_data[idx_addr_section+i*6:idx_addr_section+i*6+4], 'little')
+        length = int.from_bytes(interim_file_data[idx_addr_section+i*6+4:idx_addr_section+i*6+6], 'little')
+        data_length = int.from_bytes(interim_file_data[idx_data_section:idx_data_section+2], 'little')
+        # sanity: check that data_length is equal to the length in the addr_len section
+        if data_length != length:
+            print(f"***** ERROR: interim data internal inconsistency! *****")
+            print(f"data length {data_length} for address {addr:#010x} does not match length {length}, exiting. ******")
+            return False
+        # check that the data length is a multiple of 8 bytes
+        if data_length % 8 != 0:
+            print(f"***** ERROR: interim data internal inconsistency! *****")
+            print(f"length {data_length} for address {addr:#010x} is not a multiple of 8 bytes, exiting. ******")
+            return False
+        idx_data_section += 2  # Move to the start of the data entry
+        data = interim_file_data[idx_data_section:idx_data_section+data_length]
+        packet_stream.append(make_stream_entry(addr, data))
+        idx_data_section += data_length
+    return True
+
+def parse_patch_arg(patch_arg):
+    """Parse a --patch argument of the form ADDR=@FILE, ADDR=0xVALUE or ADDR=HEXBYTES, return (addr, source) or None."""
+    if '=' not in patch_arg:
+        print(f"***** ERROR: Patch '{patch_arg}' is not in ADDR=@FILE, ADDR=0xVALUE or ADDR=HEXBYTES format *****")
+        return None
+    addr_str, source = patch_arg.split('=', 1)
+    try:
+        addr = int(addr_str, 0)
+    except ValueError:
+        print(f"***** ERROR: Patch address '{addr_str}' is not a valid number *****")
+        return None
+    return (addr, source)
+
+def load_patches(patch_sources):
+    """Read the patch data for each (addr, source) pair, return a list of (addr, data) or None on error.
+    The source can be:
+    @FILE: the binary content of FILE
+    0xVALUE: a little-endian integer, as many bytes wide as the hex digits given, e.g. 0x0000002A is 2a 00 00 00
+    HEXBYTES: bytes in the order given, e.g. 2a:00:00:00 or 2a000000"""
+    patches = []
+    for addr, source in patch_sources:
+        if source.startswith('@'):
+            try:
+                with open(source[1:], 'rb') as f:
+                    data = f.read()
+            except IOError as e:
+                print(f"***** ERROR: Cannot read patch file {source[1:]}: {e} *****")
+                return None
+        elif source.lower().startswith('0x'):
+            digits = source[2:]
+            try:
+                data = int(digits, 16).to_bytes((len(digits) + 1) // 2, 'little')
+            except ValueError:
+                print(f"***** ERROR: Patch value '{source}' is not a valid hex number *****")
+                return None
+        else:
+            try:
+                data = bytes.fromhex(source.replace(':', ''))
+            except ValueError:
+                print(f"***** ERROR: Patch '{source}' is not valid hex bytes (use @FILE for a file) *****")
+                return None
+        if len(data) == 0:
+            print(f"***** ERROR: Patch at {addr:#010x} is empty *****")
+            return None
+        patches.append((addr, data))
+    return patches
+
+def apply_patches(base_stream, patches, max_data):
+    """Return a copy of base_stream with the patches applied. Only the packets overlapping a patch are rebuilt;
+    patch bytes outside of the base image are added as new 8-byte aligned entries padded with 0xff,
+    in packets of up to max_data bytes."""
+    stream = list(base_stream)
+    rebuilt = 0
+    for patch_addr, patch_data in patches:
+        patch_end = patch_addr + len(patch_data)
+        covered = bytearray(len(patch_data))  # set to 1 for patch bytes that land in an existing entry
+        for i, (addr, data, packet) in enumerate(stream):
+            lo = max(addr, patch_addr)
+            hi = min(addr + len(data), patch_end)
+            if lo >= hi:
+                continue
+            new_data = bytearray(data)
+            new_data[lo-addr:hi-addr] = patch_data[lo-patch_addr:hi-patch_addr]
+            stream[i] = make_stream_entry(addr, new_data)
+            covered[lo-patch_addr:hi-patch_addr] = bytes([1] * (hi - lo))
+            rebuilt += 1
+        # any uncovered runs of the patch become new entries. Gaps between entries are 8-byte aligned,
+        # so rounding a run out to 8 bytes never overlaps an existing entry
+        run_start = None
+        for offset in range(len(patch_data) + 1):
+            if offset < len(patch_data) and not covered[offset]:
+                if run_start is None:
+                    run_start = offset
+                continue
+            if run_start is None:
+                continue
+            start = (patch_addr + run_start) & ~7
+            end = (patch_addr + offset + 7) & ~7
+            data = bytearray([0xff] * (end - start))
+            data[patch_addr + run_start - start:patch_addr + offset - start] = patch_data[run_start:offset]
+            for chunk_start in range(0, len(data), max_data):
+                stream.append(make_stream_entry(start + chunk_start, data[chunk_start:chunk_start + max_data]))
+                rebuilt += 1
+            run_start = None
+        print(f"Patch: Address: {patch_addr:#010x}, Length: {len(patch_data)} bytes, Content: {patch_data.hex()}")
+    stream.sort(key=lambda entry: entry[0])
+    print(f"Rebuilt {rebuilt} of {len(stream)} packet(s) for {len(patches)} patch(es)")
+    return stream
+
+def build_flash_file_data(version, compress):
+    """Return the contents of a .flash file for the current interim data and packet stream.
+    Version 1 is the plain interim array. Version 2 uses the header to store:
+    0: 'MSPF' magic (4 bytes)
+    4: version (2 bytes, little-endian)
+    6: flags (2 bytes), bit 0 set if the DATA section is zlib compressed
+    8: target device ID (16 bytes ASCII, padded with 0x00), all 0x00 if the file is not for a specific device
+    24: number of addr_len entries (4 bytes)
+    28: total data length (4 bytes)
+    32: CRC32 of all data concatenated (4 bytes)
+    36: DATA section length, uncompressed (4 bytes)
+    40: DATA section length as stored (4 bytes)
+    44: CRC32 of header bytes 0..43 (4 bytes)
+    rest of the 256 bytes: set to 0x00
+    The ADDR section has 14 bytes per entry: 4 bytes address, 2 bytes length, 4 bytes CRC32 of the data
+    (as returned by the Standalone Verification (0x26) command) and 4 bytes CRC32 of the Program Data (0x20)
+    packet, so that packets can be rebuilt without any CRC calculation.
+    The DATA section is the same as v1 (2 bytes length + data, per entry), optionally compressed."""
+    if version == 1:
+        return bytes(interim_file_data)
+    addr_section = bytearray(b'ADDR')
+    addr_section.extend(len(packet_stream).to_bytes(2, 'little'))
+    data_section = bytearray()
+    for addr, data, packet in packet_stream:
+        addr_section.extend(addr.to_bytes(4, 'little'))
+        addr_section.extend(len(data).to_bytes(2, 'little'))
+        addr_section.extend(calc_crc(data))
+        addr_section.extend(packet[-4:])
+        data_section.extend(len(data).to_bytes(2, 'little'))
+        data_section.extend(data)
+    all_data = b''.join(data for addr, data, packet in packet_stream)
+    stored_data_section = zlib.compress(data_section, 9) if compress else data_section
+    header = bytearray(FLASH_MAGIC)
+    header.extend(FLASH_VERSION.to_bytes(2, 'little'))
+    header.extend((FLASH_FLAG_COMPRESSED if compress else 0).to_bytes(2, 'little'))
+    header.extend((target_device or '').encode('ascii')[:16].ljust(16, b'\0'))  # empty if no device was specified
+    header.extend(len(packet_stream).to_bytes(4, 'little'))
+    header.extend(len(all_data).to_bytes(4, 'little'))
+    header.extend(calc_crc(all_data))
+    header.extend(len(data_section).to_bytes(4, 'little'))
+    header.extend(len(stored_data_section).to_bytes(4, 'little'))
+    header.extend(calc_crc(header))
+    header.extend(bytearray(256 - len(header)))
+    return bytes(header + addr_section + b'DATA' + stored_data_section)
+
+def save_flash_file(flash_filename, version, compress):
+    """Save the current firmware as a .flash file."""
+    try:
+        with open(flash_filename, 'wb') as f:
+            f.write(build_flash_file_data(version, compress))
+        if verbose:
+            print(f"Saved interim .flash file (v{version}) as {flash_filename}")
+    except IOError as e:
+        print(f"Error saving interim .flash file: {e}")
+        return False
+    return True
+
+def load_flash_file(flash_filename):
+    """Load a .flash file (v1 or v2) into the packet stream, ready to send."""
+    global interim_file_data
+    global packet_stream
+    global sized_packet_stream
+    global target_device
+    try:
+        with open(flash_filename, 'rb') as f:
+            content = f.read()
+    except IOError as e:
+        print(f"***** ERROR: Cannot read {flash_filename}: {e} *****")
+        return False
+    if content[0:4] != FLASH_MAGIC:
+        # v1 file, the packet CRCs need calculating
+        if verbose:
+            print(f"Loading {flash_filename} (v1)")
+        interim_file_data = bytearray(content)
+        return build_packet_stream()
+    if len(content) < 256 + 6 or calc_crc(content[0:44]) != content[44:48]:
+        print(f"***** ERROR: {flash_filename} header is corrupt, exiting. *****")
+        return False
+    version = int.from_bytes(content[4:6], 'little')
+    flags = int.from_bytes(content[6:8], 'little')
+    target = content[8:24].rstrip(b'\0').decode('ascii', errors='replace')
+    num_entries = int.from_bytes(content[24:28], 'little')
+    total_length = int.from_bytes(content[28:32], 'little')
+    data_section_length = int.from_bytes(content[36:40], 'little')
+    stored_data_section_length = int.from_bytes(content[40:44], 'little')
+    if verbose:
+        print(f"Loading {flash_filename} (v{version}), target {target or 'any'}, {num_entries} entries, {total_length} bytes, CRC32 {content[32:36].hex()}")
+    if version != FLASH_VERSION:
+        print(f"***** ERROR: Unsupported .flash file version {version}, exiting. *****")
+        return False
+    if target != '':
+        if get_device_profile(target) is None:
+            print(f"***** ERROR: .flash file is for unknown target {target}, exiting. *****")
+            return False
+        if target_device is not None and target != target_device:
+            print(f"***** ERROR: .flash file is for target {target}, not {target_device}, exiting. *****")
+            return False
+        target_device = target
+    idx_addr_section = 256
+    idx_data_section = idx_addr_section + 6 + num_entries * 14
+    if content[idx_addr_section:idx_addr_section+4] != b'ADDR' or content[idx_data_section:idx_data_section+4] != b'DATA':
+        print(f"***** ERROR: 'ADDR' or 'DATA' section not found in {flash_filename}, exiting. *****")
+        return False
+    idx_data_section += 4
+    data_section = content[idx_data_section:idx_data_section+stored_data_section_length]
+    if flags & FLASH_FLAG_COMPRESSED:
+        try:
+            data_section = zlib.decompress(data_section)
+        except zlib.error as e:
+            print(f"***** ERROR: Cannot decompress DATA section: {e}, exiting. *****")
+            return False
+    if len(data_section) != data_section_length:
+        print(f"***** ERROR: DATA section is {len(data_section)} bytes, expected {data_section_length}, exiting. *****")
+        return False
+    # rebuild the packets by concatenation, using the stored packet CRCs. The data is checked
+    # against the stored total CRC32, so corruption is found before anything is erased on the target
+    packet_stream = []
+    sized_packet_stream = None
+    idx_addr_section += 6
+    idx_data = 0
+    data_crc = 0
+    for i in range(num_entries):
+        entry = content[idx_addr_section+i*14:idx_addr_section+i*14+14]
+        addr = int.from_bytes(entry[0:4], 'little')
+        length = int.from_bytes(entry[4:6], 'little')
+        data_length = int.from_bytes(data_section[idx_data:idx_data+2], 'little')
+        if data_length != length or length % 8 != 0:
+            print(f"***** ERROR: .flash data internal inconsistency at address {addr:#010x}, exiting. *****")
+            return False
+        data = data_section[idx_data+2:idx_data+2+length]
+        idx_data += 2 + length
+        data_crc = binascii.crc32(data, data_crc)
+        packet = bytes([0x80]) + (length + 5).to_bytes(2, 'little') + bytes([0x20]) + entry[0:4] + data + entry[10:14]
+        packet_stream.append((addr, data, packet))
+        if verbose:
+            print(f"  Entry {i}: Address: {addr:#010x}, Length: {length} bytes, CRC32: {entry[6:10].hex()}")
+    if ((data_crc ^ 0xFFFFFFFF) & 0xFFFFFFFF).to_bytes(4, 'little') != content[32:36]:
+        print(f"***** ERROR: {flash_filename} data does not match its CRC32, the file is corrupt, exiting. *****")
+        packet_stream = []
+        return False
+    interim_file_data = bytearray()  # not needed, the packet stream is built directly
+    return True
+
+def bsl_connect_and_unlock():
+    """Connect to the MSPM0 BSL, select the device profile from its device info and unlock it.
+    Returns (profile, max_packet_data) or None on failure."""
     global ser
-    global data_for_verification_calc
-    data_for_verification_calc.clear()  # Clear previous data for verification
     print("Sending Connection Command (0x12) to MSPM0 chip")
     build_packet(0x80, 0x12, bytearray())  # No data for connection command
     ser.write(data_packet)  # Send the data packet
     result = mspm0_wait_response(1, exp_bytes=1)  # wait 1 second
     if result is None or len(result) != 1 or result[0] != 0x00:
         print("***** ERROR: Failed to establish connection with MSPM0 chip, exiting. ******")
-        return False
+        return None
     print("Issuing Get Device Info Command (0x19) to MSPM0 chip")
     build_packet(0x80, 0x19, bytearray())  # No data for Get Device Info command
     ser.write(data_packet)  # Send the data packet
     result = mspm0_wait_response(2)  # wait 2 seconds, expect multiple bytes
     if result is None or len(result) < 5:
         print("***** ERROR: Failed to get device info from MSPM0 chip, exiting. ******")
-        return False
+        return None
     print(f"Received Device Info: {result.hex()}, length ={len(result)} bytes")
     cmd_interp_version = int.from_bytes(result[5:7], 'little')  # Command Interpreter Version
     build_id = int.from_bytes(result[7:9], 'little')  # Build ID
@@ -274,30 +728,19 @@ def bootload_interim_array():
     bsl_buf_start_addr = int.from_bytes(result[17:21], 'little')  # BSL Buffer Start Address
     bcr_id = int.from_bytes(result[21:25], 'little')  # BCR ID
     bsl_id = int.from_bytes(result[25:29], 'little')  # BSL ID
-    if cmd_interp_version != 0x0100:
-        print(f"***** ERROR: Unsupported Command Interpreter Version {cmd_interp_version:#04x}, exiting. ******")
-        return False
-    if build_id != 0x0100:
-        print(f"***** ERROR: Unsupported Build ID {build_id:#04x}, exiting. ******")
-        return False
-    if app_ver != 0x00000000:
-        print(f"***** ERROR: Unsupported Application Version {app_ver:#010x}, exiting. ******")
-        return False
-    if plugin_ver != 0x0001:
-        print(f"***** ERROR: Unsupported Plugin Version {plugin_ver:#04x}, exiting. ******")
-        return False
-    if bsl_max_buf_size < 1024:
-        print(f"***** ERROR: Unsupported BSL Max Buffer Size {bsl_max_buf_size:#04x}, exiting. ******")
-        return False
-    if bsl_buf_start_addr != 0x20000160:
-        print(f"***** ERROR: Unsupported BSL Buffer Start Address {bsl_buf_start_addr:#010x}, exiting. ******")
-        return False
-    if bcr_id != 0x00000001:
-        print(f"***** ERROR: Unsupported BCR ID {bcr_id:#010x}, exiting. ******")
-        return False
-    if bsl_id != 0x00000001:
-        print(f"***** ERROR: Unsupported BSL ID {bsl_id:#010x}, exiting. ******")
-        return False
+    device_info = {'cmd_interp_version': cmd_interp_version, 'build_id': build_id, 'app_ver': app_ver,
+                   'plugin_ver': plugin_ver, 'bsl_max_buf_size': bsl_max_buf_size,
+                   'bsl_buf_start_addr': bsl_buf_start_addr, 'bcr_id': bcr_id, 'bsl_id': bsl_id}
+    profile = select_device_profile(device_info)
+    if profile is None:
+        print(f"***** ERROR: Unsupported device, no matching device profile, exiting. ******")
+        return None
+    # packets must fit in the BSL buffer, and carry a multiple of 8 bytes
+    max_packet_data = ((bsl_max_buf_size - PACKET_OVERHEAD) // 8) * 8
+    if profile['max_packet_data'] is not None:
+        max_packet_data = min(max_packet_data, profile['max_packet_data'])
+    flash_size_text = f"{profile['flash_size'] // 1024} kbytes" if profile['flash_size'] is not None else "size unknown"
+    print(f"Selected device profile {profile['name']}: flash {flash_size_text}, sector {profile['sector_size']} bytes, up to {max_packet_data} data bytes per packet")
     print("Unlocking Bootloader (0x21)")
     build_packet(0x80, 0x21, bytearray([0xff] * 32))  # Send 32 bytes of 0xff for Unlock Bootloader command
     ser.write(data_packet)  # Send the data packet
@@ -309,125 +752,190 @@ def bootload_interim_array():
                 succ = True
     if not succ:
         print("***** ERROR: Failed to unlock bootloader, exiting. ******")
-        return False
+        return None
     print("Bootloader unlocked successfully")
+    return (profile, max_packet_data)
+
+def check_flash_range(addr, length, profile):
+    """Check that an address range, if it is in main flash, fits within the device flash size (if it is known)."""
+    if profile['flash_size'] is not None and addr < MAIN_FLASH_END and addr + length > profile['flash_size']:
+        print(f"***** ERROR: Address range {addr:#010x}-{addr + length - 1:#010x} is beyond the {profile['flash_size'] // 1024} kbyte flash of {profile['name']}, exiting. ******")
+        if target_device is None:
+            print("If this is a larger device, specify it with --device, e.g. --device MSPM0L1106")
+        return False
+    return True
+
+def bsl_erase_sector(addr, length):
+    """Erase one flash sector with a Flash Range Erase (0x23) command."""
+    end_addr = addr + length - 1
+    print(f"Erasing Flash block: Address {addr:#010x}, length {length} bytes")
+    build_packet(0x80, 0x23, addr.to_bytes(4, 'little') + end_addr.to_bytes(4, 'little'))
+    # print the packet for debugging
+    print(f"Sending Flash Range Erase command: {data_packet.hex()}")
+    ser.write(data_packet)
+    result = mspm0_wait_response(1)  # wait 1 second, expect multiple bytes
+    if result is None or len(result) < 10:
+        print(f"***** ERROR: Failed to erase flash range at address {addr:#010x}, exiting. ******")
+        return False
+    succ = False
+    if result[4] == 0x3b:  # BSL Core Message Response
+        if result[5] == 0x00:  # Operation Successful
+            succ = True
+    if not succ:
+        print(f"***** ERROR: Failed to erase flash range at address {addr:#010x}, exiting. ******")
+        if result[4] == 0x3b:  # BSL Core Message Response
+            if result[5] == 0x01:
+                print("BSL Lock Error")
+            elif result[5] == 0x02:
+                print("BSL Password Error")
+            elif result[5] == 0x05: 
+                print("Invalid Memory Range")
+            elif result[5] == 0x0a:
+                print("Invalid Address or Length Alignment")
+            else:
+                print(f"BSL Core Message Response MSG: {result[5]:#04x}")
+        return False
+    return True
+
+def bsl_program_packet(addr, packet):
+    """Send one Program Data (0x20) packet and check the response."""
+    # print the packet for debugging
+    print(f"Sending Program Data command: {packet.hex()}")
+    ser.write(packet)  # Send the data packet
+    result = mspm0_wait_response(1)  # wait 1 second, expect multiple bytes
+    if result is None or len(result) < 10:
+        print(f"***** ERROR: Failed to program data at address {addr:#010x}, exiting. ******")
+        return False
+    succ = False
+    if result[4] == 0x3b:  # BSL Core Message Response
+        if result[5] == 0x00:  # Operation Successful
+            succ = True
+    if not succ:
+        print(f"***** ERROR: Failed to program data at address {addr:#010x}, exiting. ******")
+        if result[4] == 0x3b:  # BSL Core Message Response
+            if result[5] == 0x01:
+                print("BSL Lock Error")
+            elif result[5] == 0x02:
+                print("BSL Password Error")
+            elif result[5] == 0x05: 
+                print("Invalid Memory Range")
+            elif result[5] == 0x0a:
+                print("Invalid Address or Length Alignment")
+            else:
+                print(f"BSL Core Message Response MSG: {result[5]:#04x}")
+        return False
+    return True
+
+def bsl_start_application():
+    """Send the Start Application (0x40) command."""
+    print(f"Sending Start Application Command (0x40) to MSPM0 chip")
+    build_packet(0x80, 0x40, bytearray())  # No data for Start Application command
+    ser.write(data_packet)  # Send the data packet
+    result = mspm0_wait_response(1,exp_bytes=1)  # wait 1 second, expect 1 byte
+    if result is None or len(result) != 1 or result[0] != 0x00:
+        print("***** ERROR: Failed to start application on MSPM0 chip, exiting. ******")
+        return False
+    print("Application started on MSPM0 successfully")
+    return True
+
+def get_sized_packet_stream(max_packet_data):
+    """Return packet_stream re-sized for max_packet_data, re-sizing only once for each loaded image."""
+    global sized_packet_stream
+    global sized_packet_data
+    if sized_packet_stream is None or sized_packet_data != max_packet_data:
+        sized_packet_stream = restream_packets(packet_stream, max_packet_data)
+        sized_packet_data = max_packet_data
+    return sized_packet_stream
+
+def bootload_interim_array(patches=None):
+    """Send bootloader commands to the MSPM0 chip, programming the packet_stream built from the interim file data,
+    with the (address, data) patches applied if given."""
+    global ser
+    global data_for_verification_calc
+    data_for_verification_calc.clear()  # Clear previous data for verification
+    connection = bsl_connect_and_unlock()
+    if connection is None:
+        return False
+    profile, max_packet_data = connection
+    stream = get_sized_packet_stream(max_packet_data)
+    if patches:
+        stream = apply_patches(stream, patches, max_packet_data)
+    for addr, data, packet in stream:
+        if not check_flash_range(addr, len(data), profile):
+            return False
+    sector_size = profile['sector_size']
     print("Performing Flash Range Erase (0x23) operation(s)")
-    idx_addr_section = 256  # Index for the address in the interim file data
-    num_addr_len_entries = int.from_bytes(interim_file_data[idx_addr_section+4:idx_addr_section+6], 'little')  # Number of addr_len entries
-    idx_addr_section += 6  # Move to the start of the addr_len section
     erase_block_list = []  # List to hold the erase blocks
-    addr_len_local_list = []  # Local list to hold address and length pairs
-    for i in range(num_addr_len_entries):
-        addr = int.from_bytes(interim_file_data[idx_addr_section+i*6:idx_addr_section+i*6+4], 'little')
-        length = int.from_bytes(interim_file_data[idx_addr_section+i*6+4:idx_addr_section+i*6+6], 'little')
-        addr_len_local_list.append((addr, length))
-        # we can only erase 1kbyte blocks, so divide addr by 1024 and round down to the nearest 1kbyte block
-        erase_start_block = (addr // 1024) * 1024  # Round down to the nearest 1kbyte block
-        # check if addr + length is in the same 1kbyte block
-        erase_end_block = ((addr + length - 1) // 1024) * 1024  # Round down to the nearest 1kbyte block
+    for i, (addr, data, packet) in enumerate(stream):
+        length = len(data)
+        # we can only erase whole sectors, so round addr down to the nearest sector
+        erase_start_block = (addr // sector_size) * sector_size  # Round down to the nearest sector
+        # check if addr + length is in the same sector
+        erase_end_block = ((addr + length - 1) // sector_size) * sector_size  # Round down to the nearest sector
         print(f"Entry {i}: Address: {addr:#010x}, Length: {length} bytes, Erase Start Block: {erase_start_block:#010x}, Erase End Block: {erase_end_block:#010x}")
-        # add erase_start_block and erase_end_block to the erase_block_list if not already present
-        if erase_start_block not in erase_block_list:
-            erase_block_list.append(erase_start_block)
-        if erase_end_block not in erase_block_list:
-            erase_block_list.append(erase_end_block)
+        # add the blocks to the erase_block_list if not already present
+        for block in range(erase_start_block, erase_end_block + 1, sector_size):
+            if block not in erase_block_list:
+                erase_block_list.append(block)
     if len(erase_block_list) == 0:
         print("***** ERROR: No Flash Range Erase operations to perform, exiting. ******")
         return False
-    for i in range(len(erase_block_list)):
-        addr = erase_block_list[i]
-        length = 1024  # Length is always 1024 bytes for each erase operation
-        end_addr = addr + length - 1
-        print(f"Erasing Flash block: Address {addr:#010x}, length {length} bytes")
-        build_packet(0x80, 0x23, addr.to_bytes(4, 'little') + end_addr.to_bytes(4, 'little'))
-        # ser.write(data_packet)  # Send the data packet
-        # print the packet for debugging
-        print(f"Sending Flash Range Erase command: {data_packet.hex()}")
-        ser.write(data_packet)
-        result = mspm0_wait_response(1)  # wait 1 second, expect multiple bytes
-        if result is None or len(result) < 10:
-            print(f"***** ERROR: Failed to erase flash range at address {addr:#010x}, exiting. ******")
-            return False
-        succ = False
-        if result[4] == 0x3b:  # BSL Core Message Response
-            if result[5] == 0x00:  # Operation Successful
-                succ = True
-        if not succ:
-            print(f"***** ERROR: Failed to erase flash range at address {addr:#010x}, exiting. ******")
-            if result[4] == 0x3b:  # BSL Core Message Response
-                if result[5] == 0x01:
-                    print("BSL Lock Error")
-                elif result[5] == 0x02:
-                    print("BSL Password Error")
-                elif result[5] == 0x05: 
-                    print("Invalid Memory Range")
-                elif result[5] == 0x0a:
-                    print("Invalid Address or Length Alignment")
-                else:
-                    print(f"BSL Core Message Response MSG: {result[5]:#04x}")
+    for addr in erase_block_list:
+        if not bsl_erase_sector(addr, sector_size):  # Length is always one sector for each erase operation
             return False
     print(f"{len(erase_block_list)} Flash Range Erase operation(s) completed successfully")
     print("Programming Data (0x20 operations) to MSPM0 chip")
-    idx = 256
-    # search for 'DATA' starting at 256 bytes offset
-    idx_data_section = interim_file_data.find(b'DATA', idx)
-    # first two bytes after 'DATA' are the length of the first data entry
-    if idx_data_section == -1:
-        print("***** ERROR: 'DATA' section not found in interim file data, exiting. ******")
-        return False
-    idx_data_section += 4  # Move to the length of the first data entry
-    for i in range(len(addr_len_local_list)):
-        addr, length = addr_len_local_list[i]
-        data_length = int.from_bytes(interim_file_data[idx_data_section:idx_data_section+2], 'little')  # Length of first data entry
-        # sanity: check that data_length is equal to the length in addr_len_local_list
-        if data_length != length:
-            print(f"***** ERROR: interim data internal inconsistency! *****")
-            print(f"data length {data_length} for address {addr:#010x} does not match length {length}, exiting. ******")
-            return False
-        idx_data_section += 2  # Move to the start of the data entry
-        data = interim_file_data[idx_data_section:idx_data_section+data_length]  # Data for the first address range
-        # check that the data length is a multiple of 8 bytes
-        if data_length % 8 != 0:
-            print(f"***** ERROR: interim data internal inconsistency! *****")
-            print(f"length {data_length} for address {addr:#010x} is not a multiple of 8 bytes, exiting. ******")
+    for i, (addr, data, packet) in enumerate(stream):
+        print(f"Programming Data Entry {i}: Address: {addr:#010x}, Length: {len(data)} bytes")
+        if not bsl_program_packet(addr, packet):  # Send the precomputed data packet
             return False
-        print(f"Programming Data Entry {i}: Address: {addr:#010x}, Length: {data_length} bytes")
-        build_packet(0x80, 0x20, addr.to_bytes(4, 'little') + data)  # Build the packet with address and data
-        # print the packet for debugging
-        print(f"Sending Program Data command: {data_packet.hex()}")
-        ser.write(data_packet)  # Send the data packet
-        result = mspm0_wait_response(1)  # wait 1 second, expect multiple bytes
-        if result is None or len(result) < 10:
-            print(f"***** ERROR: Failed to program data at address {addr:#010x}, exiting. ******")
+    print(f"{len(stream)} Data Programming operation(s) completed successfully")
+    return bsl_start_application()
+
+def bootload_stream(hex_file):
+    """Program the .hex file while it is still being read. Records are grouped into sector-sized chunks,
+    each sector is erased just before it is first written, and packets are sent as soon as they are built,
+    so only one sector of data and one packet are held in memory at a time."""
+    global data_for_verification_calc
+    data_for_verification_calc.clear()  # Clear previous data for verification
+    connection = bsl_connect_and_unlock()
+    if connection is None:
+        return False
+    profile, max_packet_data = connection
+    sector_size = profile['sector_size']
+    max_packet_data = min(max_packet_data, sector_size)
+    erased_sectors = set()
+    num_packets = 0
+    print(f"Streaming {hex_file} to MSPM0 chip")
+    chunks = hex_sector_chunks(hex_records(hex_file), sector_size)
+    while True:
+        try:
+            chunk = next(chunks, None)
+        except (OSError, ValueError) as e:
+            print(f"**** ERROR: {e}, aborting! ****")
             return False
-        succ = False
-        if result[4] == 0x3b:  # BSL Core Message Response
-            if result[5] == 0x00:  # Operation Successful
-                succ = True
-        if not succ:
-            print(f"***** ERROR: Failed to program data at address {addr:#010x}, exiting. ******")
-            if result[4] == 0x3b:  # BSL Core Message Response
-                if result[5] == 0x01:
-                    print("BSL Lock Error")
-                elif result[5] == 0x02:
-                    print("BSL Password Error")
-                elif result[5] == 0x05: 
-                    print("Invalid Memory Range")
-                elif result[5] == 0x0a:
-                    print("Invalid Address or Length Alignment")
-                else:
-                    print(f"BSL Core Message Response MSG: {result[5]:#04x}")
+        if chunk is None:
+            break
+        addr, data = chunk
+        sector = (addr // sector_size) * sector_size
+        if not check_flash_range(addr, len(data), profile):
             return False
-        idx_data_section += data_length
-    print(f"{len(addr_len_local_list)} Data Programming operation(s) completed successfully")
-    print(f"Sending Start Application Command (0x40) to MSPM0 chip")
-    build_packet(0x80, 0x40, bytearray())  # No data for Start Application command
-    ser.write(data_packet)  # Send the data packet
-    result = mspm0_wait_response(1,exp_bytes=1)  # wait 1 second, expect 1 byte
-    if result is None or len(result) != 1 or result[0] != 0x00:
-        print("***** ERROR: Failed to start application on MSPM0 chip, exiting. ******")
+        if sector not in erased_sectors:
+            if not bsl_erase_sector(sector, sector_size):
+                return False
+            erased_sectors.add(sector)
+        for offset in range(0, len(data), max_packet_data):
+            packet_data = data[offset:offset + max_packet_data]
+            print(f"Programming Data: Address: {addr + offset:#010x}, Length: {len(packet_data)} bytes")
+            build_packet(0x80, 0x20, (addr + offset).to_bytes(4, 'little') + packet_data)
+            if not bsl_program_packet(addr + offset, data_packet):
+                return False
+            num_packets += 1
+    if num_packets == 0:
+        print("***** ERROR: No data found in the .hex file, exiting. ******")
         return False
-    print("Application started on MSPM0 successfully")
+    print(f"{len(erased_sectors)} Flash Range Erase and {num_packets} Data Programming operation(s) completed successfully")
+    return bsl_start_application()
 
 def read_chip_contents():
     # not implemented yet
@@ -625,8 +1133,15 @@ def set_dtr_low():
     global ser
     ser.setDTR(True)
 
+def import_serial():
+    """Import pySerial on first use, so that conversion-only runs don't need to load it."""
+    global serial
+    if serial is None:
+        import serial
+
 def ser_test():
     global ser
+    import_serial()
     ser = serial.Serial(port, baudrate, rtscts=False, dsrdtr=False, timeout=1)
     ser.rtscts = True
     ser.rtscts = False
@@ -644,6 +1159,7 @@ def ser_open():
     global ser
     global rts_capability
     global dtr_capability
+    import_serial()
     # catch error if serial port is not available
     try:
         ser = serial.Serial(port, baudrate, rtscts=False, dsrdtr=False, timeout=1)
@@ -679,6 +1195,276 @@ def ser_close():
     else:
         print("Serial port is not open or already closed.")
 
+def convert_hex_file(hex_file):
+    """Parse the .hex file, build the interim array from it, and precompute the packet stream."""
+    if verbose:
+        print(f"Converting {hex_file} to interim format...")
+    if not hexparse(hex_file):  # Parse the hex file into lists in memory
+        print(f"***** ERROR: Failed to parse {hex_file} *****")
+        return False
+    if not build_interim_array():  # Build an interim format array from the lists
+        return False
+    return build_packet_stream()  # Precompute the packets to send
+
+def program_target(noprompt, stream_file=None, patches=None):
+    """Put the chip into BSL mode (or prompt the user to), then program the interim array with any patches applied,
+    or the .hex file stream_file directly if it is given. Serial port must be open."""
+    if noprompt:
+        print(f"Auto mode, no prompt")
+    else:
+        print(f"Hold down the BOOT button and then RESET the chip, then release the BOOT button. Press Enter to continue...")
+        input()  # Wait for user to press Enter
+    if dtr_capability:
+        set_dtr_low()  # this asserts BOOT (sets BOOT high, inverted by PNP transistor)
+    if rts_capability:
+        set_rts_low()  # assert the *RESET line (active low)
+        # time.sleep(0.1)  # doesn't seem necessary
+        set_rts_high()  # get out of reset
+# moved this further down, so that the *DTR line can also be used to 
+# route the UART signals using a SN74CBTLV3257PWR analog switch, for the
+# duration of the programming, which means no jumpers needed to be switched
+# when using the EasyL1105 Rev 2.1 board
+#    if dtr_capability:
+#        time.sleep(0.01)
+#        set_dtr_high()  #  deasserts BOOT (inverted by PNP transistor)
+    ser.reset_input_buffer()  # discard anything left over from a previous run
+    if stream_file is not None:
+        result = bootload_stream(stream_file)  # Read the .hex file and send it to the MSPM0 chip as it is parsed
+    else:
+        result = bootload_interim_array(patches)  # Convert the interim array to bootloader commands and send to MSPM0 chip
+    if dtr_capability:
+        time.sleep(0.01)
+        set_dtr_high()  #  deasserts BOOT (inverted by PNP transistor)
+    return result
+
+def program_units(patch_sources, noprompt, repeat):
+    """Program one unit (or several in sequence if repeat is set) with the patches applied on top of the
+    precomputed base packet stream. Patch files are re-read for every unit. Serial port must be open."""
+    unit = 1
+    while True:
+        print(f"Preparing unit {unit}")
+        patches = load_patches(patch_sources)
+        if patches is None:
+            return False
+        result = program_target(noprompt, patches=patches)
+        if not result:
+            print(f"***** ERROR: Programming unit {unit} failed *****")
+        else:
+            print(f"Unit {unit} programmed successfully")
+        if not repeat:
+            return result
+        print("Connect the next unit and press Enter to continue, or type q and press Enter to quit...")
+        if input().strip().lower() == 'q':
+            return True
+        unit += 1
+
+def file_hash(filename):
+    """Return the SHA-256 digest of the file contents, or None if the file cannot be read."""
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha256(f.read()).digest()
+    except IOError:
+        return None
+
+def file_stat(filename):
+    """Return (mtime, size) for the file, or None if it does not exist. Used for polling."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def inotify_open(filename):
+    """Watch the directory holding filename using inotify (Linux only). Returns the fd, or None if unavailable."""
+    import ctypes  # only needed for watch mode
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    # watch the directory rather than the file, since build tools often replace the file instead of rewriting it
+    dirname = os.path.dirname(os.path.abspath(filename))
+    wd = libc.inotify_add_watch(fd, dirname.encode(), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+    if wd < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def inotify_read_names(fd):
+    """Read all pending inotify events and return the set of file names they refer to."""
+    names = set()
+    while True:
+        try:
+            buf = os.read(fd, 4096)
+        except BlockingIOError:
+            return names
+        if not buf:
+            return names
+        # each event is: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+        offset = 0
+        while offset + 16 <= len(buf):
+            wd, mask, cookie, name_len = struct.unpack_from('iIII', buf, offset)
+            offset += 16
+            names.add(buf[offset:offset + name_len].rstrip(b'\0').decode(errors='replace'))
+            offset += name_len
+
+def watch_wait_for_change(filename, inotify_fd):
+    """Block until filename has changed, and has then been left alone for watch_debounce seconds."""
+    name = os.path.basename(filename)
+    changed = False
+    if inotify_fd is not None:
+        while True:
+            timeout = watch_debounce if changed else None
+            ready, _, _ = select.select([inotify_fd], [], [], timeout)
+            if not ready:
+                return  # debounce period expired with no further events
+            if name in inotify_read_names(inotify_fd):
+                changed = True
+    # polling fallback
+    last_stat = file_stat(filename)
+    last_change_time = 0
+    while True:
+        time.sleep(watch_poll_interval)
+        cur_stat = file_stat(filename)
+        if cur_stat != last_stat:
+            last_stat = cur_stat
+            last_change_time = time.time()
+            changed = True
+        elif changed and time.time() - last_change_time >= watch_debounce:
+            return
+
+def watch_loop(hex_file, noprompt):
+    """Keep the serial port open, and re-convert and re-program each time the .hex file content changes."""
+    inotify_fd = inotify_open(hex_file)
+    if inotify_fd is None:
+        print(f"inotify not available, polling {hex_file} every {watch_poll_interval} seconds")
+    else:
+        print(f"Using inotify to watch {hex_file}")
+    ser_open()  # Open the serial port once, for the whole session
+    last_hash = None
+    try:
+        while True:
+            digest = file_hash(hex_file)
+            if digest is None:
+                print(f"Cannot read {hex_file}, waiting for it to appear...")
+            elif digest == last_hash:
+                print(f"{hex_file} content unchanged, not re-programming")
+            else:
+                start_time = time.time()
+                if convert_hex_file(hex_file) and program_target(noprompt):
+                    last_hash = digest
+                    print(f"Programming complete. Elapsed time: {time.time() - start_time:.2f} seconds")
+                else:
+                    print("***** ERROR: Programming failed, will retry on the next file change *****")
+            print(f"Watching {hex_file} for changes, press Ctrl-C to exit...")
+            watch_wait_for_change(hex_file, inotify_fd)
+    except KeyboardInterrupt:
+        print("\nWatch mode stopped.")
+    finally:
+        if inotify_fd is not None:
+            os.close(inotify_fd)
+        ser_close()
+
+def convert_one(job):
+    """Convert a single .hex (or .flash) file to a .flash file. Runs in a worker process for the convert subcommand.
+    job is a tuple of (input filename, output filename, device, flash version, compress).
+    Returns a tuple of (input filename, input size in bytes, success)."""
+    global verbose
+    global target_device
+    input_filename, output_filename, device, version, compress = job
+    verbose = False
+    target_device = device
+    if not os.path.isfile(input_filename):
+        print(f"***** ERROR: Cannot find {input_filename} *****")
+        return (input_filename, 0, False)
+    size = os.path.getsize(input_filename)
+    # a bad input file shouldn't stop the rest of the batch
+    try:
+        if input_filename.lower().endswith('.flash'):
+            ok = load_flash_file(input_filename)
+            if ok and version == 1 and len(interim_file_data) == 0:
+                print(f"***** ERROR: {input_filename} is a v2 .flash file, cannot convert it to v1 *****")
+                ok = False
+        else:
+            ok = convert_hex_file(input_filename)
+        if ok:
+            ok = save_flash_file(output_filename, version, compress)
+    except (OSError, ValueError) as e:
+        print(f"***** ERROR: Cannot convert {input_filename}: {e} *****")
+        return (input_filename, size, False)
+    return (input_filename, size, ok)
+
+def convert_main(argv):
+    """Convert many .hex files to .flash files, in parallel worker processes."""
+    parser = argparse.ArgumentParser(prog='mspm0_prog.py convert', description='Convert .hex files to .flash files')
+    parser.add_argument('inputs', type=str, nargs='+', help='.hex (or .flash) files, or directories containing .hex files')
+    parser.add_argument('--outdir', type=str, default=None, help='Directory to save the .flash files in (default: next to each input file)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--device', type=str, default=None, help=f'Device profile to convert for (default: {DEFAULT_DEVICE})')
+    parser.add_argument('--flashversion', type=int, choices=[1, 2], default=FLASH_VERSION, help='.flash file format version to save (default: 2)')
+    parser.add_argument('--compress', action='store_true', help='Compress the data in the saved .flash files (v2 only)')
+    args = parser.parse_args(argv)
+    if args.compress and args.flashversion == 1:
+        print("***** ERROR: --compress is only supported with --flashversion 2 *****")
+        exit(1)
+    device = None
+    if args.device:
+        profile = get_device_profile(args.device)
+        if profile is None:
+            print(f"***** ERROR: Unknown device {args.device}, supported devices: {', '.join(p['name'] for p in device_profiles)} *****")
+            exit(1)
+        device = profile['name']
+    # collect the input files
+    input_filenames = []
+    for input_arg in args.inputs:
+        if os.path.isdir(input_arg):
+            input_filenames.extend(sorted(os.path.join(input_arg, name) for name in os.listdir(input_arg) if name.lower().endswith('.hex')))
+        else:
+            input_filenames.append(input_arg)
+    if len(input_filenames) == 0:
+        print("***** ERROR: No .hex files found to convert *****")
+        exit(1)
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+    jobs = []
+    for input_filename in input_filenames:
+        output_filename = os.path.splitext(input_filename)[0] + '.flash'
+        if args.outdir:
+            output_filename = os.path.join(args.outdir, os.path.basename(output_filename))
+        if os.path.abspath(output_filename) == os.path.abspath(input_filename):
+            output_filename = os.path.splitext(output_filename)[0] + f'_v{args.flashversion}.flash'
+        jobs.append((input_filename, output_filename, device, args.flashversion, args.compress))
+    # make sure no two inputs would be saved to the same .flash file (ignoring case, for Windows)
+    output_owners = {}
+    for input_filename, output_filename, device, version, compress in jobs:
+        output_owners.setdefault(os.path.normcase(os.path.abspath(output_filename)).lower(), []).append(input_filename)
+    duplicates = [owners for owners in output_owners.values() if len(owners) > 1]
+    if len(duplicates) > 0:
+        for owners in duplicates:
+            print(f"***** ERROR: {', '.join(owners)} would all be saved to the same .flash file *****")
+        exit(1)
+    num_workers = max(1, min(args.jobs, len(jobs)))
+    print(f"Converting {len(jobs)} file(s) using {num_workers} worker process(es)...")
+    start_time = time.time()
+    if num_workers == 1:
+        results = [convert_one(job) for job in jobs]
+    else:
+        import concurrent.futures  # only needed when converting with several worker processes
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(convert_one, jobs, chunksize=max(1, len(jobs) // (num_workers * 4))))
+    elapsed_time = max(time.time() - start_time, 1e-6)
+    failed = [input_filename for input_filename, input_size, ok in results if not ok]
+    for input_filename in failed:
+        print(f"***** ERROR: Failed to convert {input_filename} *****")
+    total_bytes = sum(input_size for input_filename, input_size, ok in results)
+    print(f"Converted {len(results) - len(failed)} of {len(results)} file(s) in {elapsed_time:.2f} seconds")
+    print(f"Throughput: {len(results) / elapsed_time:.1f} files/s, {total_bytes / elapsed_time / 1e6:.2f} MB/s")
+    if len(failed) > 0:
+        exit(1)
+
 # main function
 def main():
     """MSPM0 BSL programmer."""
@@ -686,8 +1472,13 @@ def main():
     global port
     global rts_capability
     global dtr_capability
+    global target_device
     noprompt = False
     start_time = time.time()
+    # the convert subcommand needs no banner, sanity check or serial port
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        convert_main(sys.argv[2:])
+        return
     print_banner()
     sanity_check()
 
@@ -697,7 +1488,14 @@ def main():
     parser.add_argument('firmware', type=str, help='Firmware file to program [.hex or .flash] or "sim" to simulate BSL')
     parser.add_argument('--auto', action='store_true', help='Automatic mode, no prompt, requires DTR and RTS capability')
     parser.add_argument('--saveflashfile', action='store_true', help='Save a copy of firmware.flash converted from the .hex file')
+    parser.add_argument('--device', type=str, default=None, help='Device profile to use, e.g. MSPM0L1106 (default: selected from the device info)')
+    parser.add_argument('--flashversion', type=int, choices=[1, 2], default=FLASH_VERSION, help='.flash file format version to save (default: 2)')
+    parser.add_argument('--compress', action='store_true', help='Compress the data in the saved .flash file (v2 only)')
     parser.add_argument('--readchip', action='store_true', help='Read the chip contents and save to firmware_readback.hex file')
+    parser.add_argument('--watch', action='store_true', help='Keep the port open and re-program whenever the .hex file changes')
+    parser.add_argument('--stream', action='store_true', help='Program the .hex file while reading it, without converting it in memory first')
+    parser.add_argument('--patch', type=str, action='append', default=[], help='Patch per-unit data on top of the firmware, ADDR=@FILE, ADDR=0xVALUE (little-endian) or ADDR=HEXBYTES (can be repeated)')
+    parser.add_argument('--repeat', action='store_true', help='With --patch, keep programming units one after another, re-reading patch files each time')
     args = parser.parse_args()
     if args.port:
         port = args.port
@@ -728,52 +1526,91 @@ def main():
         ser_close()
         return
     
+    if args.compress and args.flashversion == 1:
+        print("***** ERROR: --compress is only supported with --flashversion 2, exiting. *****")
+        return
+
+    if args.device:
+        profile = get_device_profile(args.device)
+        if profile is None:
+            print(f"***** ERROR: Unknown device {args.device}, supported devices: {', '.join(p['name'] for p in device_profiles)} *****")
+            return
+        target_device = profile['name']
+
+    patch_sources = []
+    for patch_arg in args.patch:
+        patch_source = parse_patch_arg(patch_arg)
+        if patch_source is None:
+            return
+        patch_sources.append(patch_source)
+    if args.repeat and not patch_sources:
+        print("***** ERROR: --repeat requires --patch, exiting. *****")
+        return
+    if args.watch and patch_sources:
+        print("***** ERROR: --watch cannot be used with --patch, exiting. *****")
+        return
+
+    # Streaming mode: program the .hex file as it is being read
+    if args.stream:
+        if not args.firmware.lower().endswith('.hex'):
+            print("***** ERROR: --stream requires a .hex firmware file, exiting. *****")
+            return
+        if args.watch or args.saveflashfile or patch_sources:
+            print("***** ERROR: --stream cannot be used with --watch, --saveflashfile or --patch, exiting. *****")
+            return
+        # The file is only read once the bootloader is unlocked, so check it can be opened first
+        try:
+            with open(args.firmware, 'r'):
+                pass
+        except OSError as e:
+            print(f"***** ERROR: Cannot open {args.firmware}: {e.strerror}, exiting. *****")
+            return
+        ser_open()  # Open the serial port
+        program_target(noprompt, stream_file=args.firmware)
+        ser_close()
+        if noprompt:
+            print(f"Elapsed time: {time.time() - start_time:.2f} seconds")
+        print("Programming complete.")
+        return
+
+    # Watch mode: keep the serial port open and re-program whenever the .hex file changes
+    if args.watch:
+        if not args.firmware.lower().endswith('.hex'):
+            print("***** ERROR: --watch requires a .hex firmware file, exiting. *****")
+            return
+        if port == 'none':
+            print("***** ERROR: --watch requires a serial port, exiting. *****")
+            return
+        watch_loop(args.firmware, noprompt)
+        return
+
     # Convert .hex to .flash if the firmware file is a .hex file
     if args.firmware.lower().endswith('.hex'):
-        print(f"Converting {args.firmware} to interim format...")
-        hexparse(args.firmware)  # Parse the hex file into lists in memory
-        build_interim_array()  # Build an interim format array from the lists
+        if not convert_hex_file(args.firmware):
+            return
         if args.saveflashfile:
-            flash_filename = args.firmware[:-4] + '.flash'
-            try:
-                with open(flash_filename, 'wb') as f:
-                    f.write(interim_file_data)
-                print(f"Saved interim .flash file as {flash_filename}")
-            except IOError as e:
-                print(f"Error saving interim .flash file: {e}")
+            save_flash_file(args.firmware[:-4] + '.flash', args.flashversion, args.compress)
             if port=='none':
                 return
-        ser_open()  # Open the serial port
-        if noprompt:
-            print(f"Auto mode, no prompt")
-        else:
-            print(f"Hold down the BOOT button and then RESET the chip, then release the BOOT button. Press Enter to continue...")
-            input()  # Wait for user to press Enter
-        if dtr_capability:
-            set_dtr_low()  # this asserts BOOT (sets BOOT high, inverted by PNP transistor)
-        if rts_capability:
-            set_rts_low()  # assert the *RESET line (active low)
-            # time.sleep(0.1)  # doesn't seem necessary
-            set_rts_high()  # get out of reset
-# moved this further down, so that the *DTR line can also be used to 
-# route the UART signals using a SN74CBTLV3257PWR analog switch, for the
-# duration of the programming, which means no jumpers needed to be switched
-# when using the EasyL1105 Rev 2.1 board
-#        if dtr_capability:
-#            time.sleep(0.01)
-#            set_dtr_high()  #  deasserts BOOT (inverted by PNP transistor)
-        bootload_interim_array()  # Convert the interim array to bootloader commands and send to MSPM0 chip
-        if dtr_capability:
-            time.sleep(0.01)
-            set_dtr_high()  #  deasserts BOOT (inverted by PNP transistor)
-        ser_close()
-        if noprompt:
-            stop_time = time.time()
-            elapsed_time = stop_time - start_time
-            print(f"Elapsed time: {elapsed_time:.2f} seconds")
-        print("Programming complete.")
-        
-        args.firmware = args.firmware[:-4] + '.flash'  # Change the extension to .flash
+    elif args.firmware.lower().endswith('.flash'):
+        if not load_flash_file(args.firmware):
+            return
+        if port=='none':
+            return
+    else:
+        print(f"***** ERROR: Unsupported firmware file {args.firmware}, expected .hex or .flash *****")
+        return
+    ser_open()  # Open the serial port
+    if patch_sources:
+        program_units(patch_sources, noprompt, args.repeat)
+    else:
+        program_target(noprompt)
+    ser_close()
+    if noprompt:
+        stop_time = time.time()
+        elapsed_time = stop_time - start_time
+        print(f"Elapsed time: {elapsed_time:.2f} seconds")
+    print("Programming complete.")
 
 # Run the main function
 if __name__ == "__main__":